@@ -2,27 +2,89 @@
 """
 Fast Wan video generation with model preloading.
 Models are loaded once and kept in memory for quick inference.
+
+Run with --serve to keep the pipeline resident in a background process;
+subsequent invocations send their arguments over a Unix socket instead of
+reloading the checkpoints.
 """
 
 import argparse
+import contextlib
+import gc
+import hashlib
+import json
 import logging
+import math
 import os
+import socket
+import socketserver
 import sys
+import threading
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 warnings.filterwarnings('ignore')
 
+# Let the caching allocator grow segments in place instead of fragmenting
+# across many fixed-size ones. This covers the default pool, which holds the
+# weights and caches; private pools (the per-request MemPool, CUDA graphs)
+# keep fixed segments. Must be set before the first CUDA allocation
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import random
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
 from PIL import Image
 
 import wan
 from wan.configs import MAX_AREA_CONFIGS, SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
-from wan.utils.utils import cache_video, str2bool
+from wan.modules.attention import ATTENTION_BACKENDS, set_attention_backend
+from wan.utils.utils import str2bool, video_to_uint8, write_video
+
+# Global model cache, ordered from least to most recently used
+_MODEL_CACHE = OrderedDict()
+_MAX_CACHED_GENERATORS = 1
+
+DEFAULT_SOCKET_PATH = "/tmp/wan.sock"
+
+# get_generator() arguments a client sends along with each request
+REQUEST_MODEL_KWARGS = ("task", "ckpt_dir")
+
+# Number of encoded prompts kept per generator
+_MAX_CACHED_PROMPTS = 64
+
+# Reference images that fit in the pinned staging buffer
+_MAX_REF_IMAGES = 4
 
-# Global model cache
-_MODEL_CACHE = {}
+# Number of decoded reference images kept on the GPU per generator
+_MAX_CACHED_REFS = 16
+
+# Background threads encoding finished videos to mp4
+_ENCODE_WORKERS = 2
+
+# DiT CUDA graphs kept per generator, each holding a private activation pool
+_MAX_CUDA_GRAPHS = 8
+
+# (size, frame_num) pairs seen by earlier runs, replayed when a server starts
+# so cuDNN benchmarks its conv algorithms before the first request. They are
+# recorded per task, checkpoint, dtype and quantization
+WARMUP_SHAPES_PATH = os.path.expanduser("~/.cache/wan/warmup_shapes.json")
+# Most recently recorded shapes kept per configuration in WARMUP_SHAPES_PATH
+_MAX_WARMUP_SHAPES = 4
+
+# Weight dtypes selectable with --dtype
+DTYPES = {
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+    "fp32": torch.float32,
+}
+
+# Weight-only DiT quantization selectable with --quantize, via bitsandbytes
+QUANTIZE_MODES = ("none", "int8", "nf4")
 
 def _init_logging():
     logging.basicConfig(
@@ -31,10 +93,220 @@ def _init_logging():
         handlers=[logging.StreamHandler(stream=sys.stdout)])
 
 
+def _read_warmup_shapes(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            shapes = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return shapes if isinstance(shapes, dict) else {}
+
+
+def _load_warmup_shapes(key, path=WARMUP_SHAPES_PATH):
+    shapes = _read_warmup_shapes(path).get(key, [])
+    return [tuple(shape) for shape in shapes][-_MAX_WARMUP_SHAPES:]
+
+
+def _save_warmup_shapes(key, shapes, path=WARMUP_SHAPES_PATH):
+    all_shapes = _read_warmup_shapes(path)
+    all_shapes[key] = shapes
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(all_shapes, f)
+
+
+def _pad_contexts(context, text_len):
+    """Zero-pad T5 contexts to text_len, as the DiT does internally"""
+    return [F.pad(u, (0, 0, 0, text_len - u.size(0))) for u in context]
+
+
+def _init_distributed(ulysses_size):
+    """
+    Join the process group of a torchrun-style launch, one process per GPU,
+    and split the DiT's attention heads across it with Ulysses parallelism.
+    
+    Returns:
+        Local rank, the GPU this process drives
+    """
+    world_size = int(os.getenv("WORLD_SIZE", 1))
+    if world_size != ulysses_size:
+        raise ValueError(
+            f"ulysses_size={ulysses_size} needs one process per GPU, "
+            f"got WORLD_SIZE={world_size}")
+    local_rank = int(os.getenv("LOCAL_RANK", 0))
+    if not dist.is_initialized():
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group(
+            backend="nccl",
+            init_method="env://",
+            rank=int(os.getenv("RANK", 0)),
+            world_size=world_size)
+        
+        from xfuser.core.distributed import (
+            init_distributed_environment,
+            initialize_model_parallel,
+        )
+        init_distributed_environment(
+            rank=dist.get_rank(), world_size=world_size)
+        initialize_model_parallel(
+            sequence_parallel_degree=world_size,
+            ring_degree=1,
+            ulysses_degree=ulysses_size)
+    return local_rank
+
+
+def _quantized_linear(bnb, linear, quantize, compute_dtype):
+    """Build a bitsandbytes int8 or NF4 layer holding a Linear's weights"""
+    weight = linear.weight.data.to("cpu", torch.float16)
+    has_bias = linear.bias is not None
+    if quantize == "int8":
+        qlinear = bnb.nn.Linear8bitLt(
+            linear.in_features, linear.out_features, bias=has_bias,
+            has_fp16_weights=False)
+        qlinear.weight = bnb.nn.Int8Params(
+            weight, requires_grad=False, has_fp16_weights=False)
+    else:
+        qlinear = bnb.nn.Linear4bit(
+            linear.in_features, linear.out_features, bias=has_bias,
+            compute_dtype=compute_dtype, quant_type="nf4")
+        qlinear.weight = bnb.nn.Params4bit(
+            weight, requires_grad=False, quant_type="nf4")
+    if has_bias:
+        qlinear.bias = torch.nn.Parameter(linear.bias.data, requires_grad=False)
+    # Weights are quantized as they move to the GPU
+    return qlinear.to(linear.weight.device)
+
+
+class _DiTWrapper(torch.nn.Module):
+    """Base for DiT wrappers; unknown attributes resolve on the wrapped model"""
+    
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(super().__getattr__("model"), name)
+
+
+class _CompiledDiT(_DiTWrapper):
+    """
+    Run the DiT forward through torch.compile.
+    
+    Text contexts are padded to text_len so every prompt reuses one compiled
+    graph. Outputs are cloned because reduce-overhead replays CUDA graphs
+    whose outputs are overwritten by the next call.
+    """
+    
+    def __init__(self, model, text_len, mode="reduce-overhead"):
+        super().__init__()
+        self.model = model
+        self.text_len = text_len
+        self._forward = torch.compile(
+            model.forward, mode=mode, fullgraph=False, dynamic=False)
+    
+    def forward(self, x, t, vace_context, context, seq_len, vace_context_scale=1.0):
+        torch.compiler.cudagraph_mark_step_begin()
+        output = self._forward(
+            x, t=t, vace_context=vace_context,
+            context=_pad_contexts(context, self.text_len),
+            seq_len=seq_len, vace_context_scale=vace_context_scale)
+        return [u.clone() for u in output]
+
+
+class _CUDAGraphDiT(_DiTWrapper):
+    """
+    Replay the DiT forward from a CUDA graph captured per input shape.
+    
+    Inputs are copied into static tensors before each replay. Text contexts
+    are zero-padded to text_len, as the model does internally, so the
+    prompt and negative prompt share one graph. Graphs are dropped when the
+    weights move, e.g. after offloading to CPU, and the least recently used
+    one is dropped beyond _MAX_CUDA_GRAPHS shapes.
+    """
+    
+    def __init__(self, model, text_len):
+        super().__init__()
+        self.model = model
+        self.text_len = text_len
+        self._graph_cache = OrderedDict()
+        self._weights_ptrs = None
+    
+    def _capture(self, x, t, vace_context, context, seq_len, vace_context_scale):
+        static = dict(
+            x=[u.clone() for u in x],
+            t=t.clone(),
+            vace_context=[u.clone() for u in vace_context],
+            context=[u.clone() for u in context],
+        )
+        
+        # Warm up on a side stream so lazy initialization stays out of the graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(2):
+                self.model(
+                    seq_len=seq_len, vace_context_scale=vace_context_scale, **static)
+        torch.cuda.current_stream().wait_stream(stream)
+        
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            output = self.model(
+                seq_len=seq_len, vace_context_scale=vace_context_scale, **static)
+        return graph, static, output
+    
+    def forward(self, x, t, vace_context, context, seq_len, vace_context_scale=1.0):
+        context = _pad_contexts(context, self.text_len)
+        # A reload after offloading can give one parameter its old address
+        # back while others move, so every address is compared
+        weights_ptrs = tuple(p.data_ptr() for p in self.model.parameters())
+        if weights_ptrs != self._weights_ptrs:
+            self._graph_cache.clear()
+            self._weights_ptrs = weights_ptrs
+        
+        key = (
+            tuple(u.shape for u in x),
+            tuple(u.shape for u in vace_context),
+            seq_len,
+            vace_context_scale,
+            torch.get_autocast_gpu_dtype(),
+        )
+        if key not in self._graph_cache:
+            logging.info(f"Capturing DiT CUDA graph for {key[:2]}")
+            try:
+                self._graph_cache[key] = self._capture(
+                    x, t, vace_context, context, seq_len, vace_context_scale)
+            except RuntimeError:
+                logging.warning(
+                    "CUDA graph capture failed, running the DiT eagerly",
+                    exc_info=True)
+                self._graph_cache[key] = None
+            while len(self._graph_cache) > _MAX_CUDA_GRAPHS:
+                self._graph_cache.popitem(last=False)
+        self._graph_cache.move_to_end(key)
+        
+        entry = self._graph_cache[key]
+        if entry is None:
+            return self.model(
+                x, t=t, vace_context=vace_context, context=context,
+                seq_len=seq_len, vace_context_scale=vace_context_scale)
+        
+        graph, static, output = entry
+        for name, value in (("x", x), ("vace_context", vace_context),
+                            ("context", context)):
+            for dst, src in zip(static[name], value):
+                dst.copy_(src)
+        static["t"].copy_(t)
+        graph.replay()
+        # The next replay overwrites the static output
+        return [u.clone() for u in output]
+
+
 class WanFastGenerator:
     """Fast Wan generator with model preloading"""
     
-    def __init__(self, task="vace-1.3B", ckpt_dir=None, device_id=0):
+    def __init__(self, task="vace-1.3B", ckpt_dir=None, device_id=0, t5_cpu=True,
+                 dtype="bf16", cuda_graph=False, compile=False,
+                 attention_backend="auto", cudnn_benchmark=True,
+                 mem_pool=True, quantize="none", ulysses_size=1):
         """
         Initialize and load models once
         
@@ -42,15 +314,77 @@ class WanFastGenerator:
             task: Task type (e.g., "vace-1.3B")
             ckpt_dir: Path to checkpoint directory
             device_id: GPU device ID
+            t5_cpu: Whether to keep the T5 encoder on CPU, freeing its GPU
+                memory. It runs once per uncached prompt, and the embeddings
+                upload while the VAE encodes the references
+            dtype: DiT weight dtype, one of DTYPES ("fp32" keeps autocast only)
+            cuda_graph: Whether to replay the DiT forward from CUDA graphs
+            compile: Whether to torch.compile the DiT (mode="reduce-overhead")
+            attention_backend: Attention kernel, one of ATTENTION_BACKENDS
+            cudnn_benchmark: Whether to autotune cuDNN convs and record
+                request shapes in WARMUP_SHAPES_PATH for pretune()
+            mem_pool: Whether to allocate per-request tensors from a dedicated
+                CUDA memory pool, separate from the resident weights
+            quantize: DiT block weight quantization, one of QUANTIZE_MODES;
+                quantized weights stay on the GPU even with offload_model
+            ulysses_size: Number of GPUs to split the DiT across. Above 1 every
+                rank of a torchrun-style launch constructs a generator and
+                makes the same calls, device_id is replaced by the local rank
+                and only rank 0 writes videos
         """
+        if cuda_graph and compile:
+            raise ValueError(
+                "cuda_graph and compile are exclusive, reduce-overhead "
+                "compilation already replays CUDA graphs")
+        if cuda_graph and quantize != "none":
+            raise ValueError(
+                "cuda_graph does not support quantize, bitsandbytes int8 "
+                "matmuls synchronize with the host")
+        if ulysses_size > 1 and (cuda_graph or compile or quantize != "none"):
+            raise ValueError(
+                "ulysses_size > 1 shards the DiT with FSDP, which does not "
+                "support cuda_graph, compile or quantize")
+        
+        self.cfg = WAN_CONFIGS[task]
+        self.rank = 0
+        if ulysses_size > 1:
+            if self.cfg.num_heads % ulysses_size != 0:
+                raise ValueError(
+                    f"{self.cfg.num_heads} attention heads cannot be split "
+                    f"across ulysses_size={ulysses_size} GPUs")
+            device_id = _init_distributed(ulysses_size)
+            self.rank = dist.get_rank()
+        
         self.task = task
         self.ckpt_dir = ckpt_dir
         self.device_id = device_id
-        self.cfg = WAN_CONFIGS[task]
+        self.t5_cpu = t5_cpu
+        self.ulysses_size = ulysses_size
+        # Offloading suits a one-shot run, get_generator() turns it off once
+        # the generator is reused
+        self._offload_default = True
+        # T5 outputs keyed by prompt hash, ordered from least to most recently used
+        self._prompt_cache = OrderedDict()
+        # Device RNGs reseeded for every request, one per video in a batch
+        self._seed_generators = []
+        # Decoded and letterboxed reference images on the GPU, keyed by
+        # (path, mtime, size) and ordered the same way
+        self._ref_cache = OrderedDict()
         
         _init_logging()
         logging.info(f"Initializing WanFastGenerator for task: {task}")
         logging.info(f"Checkpoint directory: {ckpt_dir}")
+        logging.info(f"Attention backend: {attention_backend}")
+        set_attention_backend(attention_backend)
+        
+        torch.backends.cudnn.benchmark = cudnn_benchmark
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        self.cudnn_benchmark = cudnn_benchmark
+        self._warmup_key = "|".join(
+            (task, os.path.abspath(ckpt_dir), dtype, quantize))
+        self._warmup_shapes = (
+            _load_warmup_shapes(self._warmup_key) if cudnn_benchmark else [])
         
         # Load model
         if "vace" in task:
@@ -59,15 +393,255 @@ class WanFastGenerator:
                 config=self.cfg,
                 checkpoint_dir=ckpt_dir,
                 device_id=device_id,
-                rank=0,
+                rank=self.rank,
                 t5_fsdp=False,
-                dit_fsdp=False,
-                use_usp=False,
-                t5_cpu=False,
+                dit_fsdp=ulysses_size > 1,
+                use_usp=ulysses_size > 1,
+                t5_cpu=t5_cpu,
             )
             logging.info("✓ VACE pipeline loaded successfully!")
         else:
             raise NotImplementedError(f"Task {task} not yet supported in fast mode")
+        
+        # Unwrapped DiT, for access to its config and submodules
+        self.dit = self.pipeline.model
+        if ulysses_size > 1:
+            # FSDP gathers each block's shards in bf16 for the forward
+            logging.info("DiT sharded with FSDP, ignoring dtype")
+        elif DTYPES[dtype] != torch.float32:
+            self._cast_dit_weights(DTYPES[dtype])
+        self.quantize = quantize
+        if quantize != "none":
+            self._quantize_dit(quantize)
+        
+        if cuda_graph:
+            self.pipeline.model = _CUDAGraphDiT(self.dit, self.cfg.text_len)
+        elif compile:
+            logging.info("Compiling DiT with torch.compile (reduce-overhead)")
+            self.pipeline.model = _CompiledDiT(self.dit, self.cfg.text_len)
+        if cuda_graph or compile:
+            self.warmup()
+        
+        # CUDA graphs allocate from their own private pools
+        self._mem_pool = None
+        if mem_pool and not (cuda_graph or compile):
+            if hasattr(torch.cuda, "MemPool"):
+                self._mem_pool = torch.cuda.MemPool()
+            else:
+                logging.warning("torch.cuda.MemPool is unavailable, using the default pool")
+        
+        # Pinned staging buffer for reference images, sized for the largest
+        # supported resolution so it is allocated only once
+        max_area = max(
+            SIZE_CONFIGS[s][0] * SIZE_CONFIGS[s][1] for s in SUPPORTED_SIZES[task])
+        self._ref_staging = torch.empty(
+            _MAX_REF_IMAGES * 3 * max_area, dtype=torch.float32, pin_memory=True)
+        self._ref_staging_event = None
+        
+        # mp4 encoding runs on the CPU, off the path of the next request
+        self._encode_pool = ThreadPoolExecutor(
+            max_workers=_ENCODE_WORKERS, thread_name_prefix="wan-encode")
+        self._pending_saves = {}
+        # Finished frames are copied into pinned buffers on a side stream,
+        # and a buffer is reused once its encode is done
+        self._copy_stream = torch.cuda.Stream(self.pipeline.device)
+        self._frames_host = []
+        self._frames_host_lock = threading.Lock()
+    
+    def _request_memory(self):
+        """Context routing allocations to the per-request memory pool"""
+        if self._mem_pool is None:
+            return contextlib.nullcontext()
+        return torch.cuda.use_mem_pool(self._mem_pool, self.pipeline.device)
+    
+    def _cast_dit_weights(self, dtype):
+        """
+        Store the DiT's attention and FFN weights in a half dtype once at load.
+        
+        Autocast otherwise re-casts every fp32 weight on each forward. Time
+        embeddings, modulation, norms and the head run under fp32 autocast
+        and are left in fp32.
+        """
+        logging.info(f"Casting DiT block weights to {dtype}")
+        self.pipeline.param_dtype = dtype
+        for blocks in (self.dit.blocks, self.dit.vace_blocks):
+            for module in blocks.modules():
+                if isinstance(module, torch.nn.Linear):
+                    module.to(dtype)
+    
+    def _quantize_dit(self, quantize):
+        """
+        Replace the DiT's attention and FFN linears with bitsandbytes layers.
+        
+        The DiT is bound by reading its weights each step, int8 halves and
+        NF4 quarters those bytes. Matmuls still run in the autocast dtype.
+        """
+        try:
+            import bitsandbytes as bnb
+        except ModuleNotFoundError as e:
+            raise ImportError(
+                f"quantize={quantize!r} requires bitsandbytes") from e
+        
+        logging.info(f"Quantizing DiT block weights to {quantize}")
+        for blocks in (self.dit.blocks, self.dit.vace_blocks):
+            for parent in list(blocks.modules()):
+                for name, module in list(parent.named_children()):
+                    if isinstance(module, torch.nn.Linear):
+                        setattr(parent, name, _quantized_linear(
+                            bnb, module, quantize, self.pipeline.param_dtype))
+        gc.collect()
+        torch.cuda.empty_cache()
+    
+    def pretune(self):
+        """
+        Warm up the DiT and VAE for the shapes recent runs recorded, so a
+        resident server's first requests skip cuDNN autotuning. One-shot
+        runs skip this, they would pay for shapes they may never use. A
+        shape that fails, e.g. by running out of memory, is forgotten.
+        """
+        for size, frame_num in list(self._warmup_shapes):
+            try:
+                self.warmup(size, frame_num, num_runs=1, vae=True)
+            except Exception:
+                logging.warning(
+                    f"Warmup failed for {size}, {frame_num} frames, "
+                    "dropping the shape", exc_info=True)
+                self._warmup_shapes.remove((size, frame_num))
+                gc.collect()
+                torch.cuda.empty_cache()
+                if self.rank == 0:
+                    _save_warmup_shapes(self._warmup_key, self._warmup_shapes)
+    
+    def warmup(self, size="832*480", frame_num=41, num_runs=3, vae=False):
+        """
+        Run the DiT on dummy inputs so compilation, graph capture and cuDNN
+        autotuning for this resolution happen before the first real request.
+        
+        Args:
+            size: Video size (e.g., "832*480")
+            frame_num: Number of frames
+            num_runs: Number of forward passes
+            vae: Whether to also run a short VAE encode and decode
+        """
+        width, height = SIZE_CONFIGS[size]
+        latent_shape = (
+            (frame_num - 1) // self.cfg.vae_stride[0] + 1,
+            height // self.cfg.vae_stride[1],
+            width // self.cfg.vae_stride[2],
+        )
+        seq_len = math.ceil(
+            math.prod(latent_shape) /
+            (self.cfg.patch_size[1] * self.cfg.patch_size[2]))
+        device = self.pipeline.device
+        
+        logging.info(f"Warming up DiT for {size}, {frame_num} frames")
+        if vae:
+            # The VAE runs in chunks of 4 frames after the first, so five
+            # frames cover every conv shape at this resolution
+            with torch.inference_mode():
+                self.pipeline.vae.encode(
+                    [torch.zeros(3, 5, height, width, device=device)])
+                self.pipeline.vae.decode([torch.zeros(
+                    self.pipeline.vae.model.z_dim, 2, *latent_shape[1:],
+                    device=device)])
+        x = [torch.zeros(
+            self.pipeline.vae.model.z_dim, *latent_shape, device=device)]
+        vace_context = [torch.zeros(
+            self.dit.vace_in_dim, *latent_shape, device=device)]
+        context = [torch.zeros(
+            self.cfg.text_len, self.dit.text_dim,
+            dtype=self.cfg.t5_dtype, device=device)]
+        t = torch.full((1,), self.cfg.num_train_timesteps - 1,
+                       dtype=torch.int64, device=device)
+        
+        with torch.inference_mode(), torch.autocast(
+                "cuda", dtype=self.pipeline.param_dtype):
+            for _ in range(num_runs):
+                self.pipeline.model(
+                    x, t=t, vace_context=vace_context, context=context,
+                    seq_len=seq_len)
+        torch.cuda.synchronize(device)
+    
+    def _load_refs_to_staging(self, paths, size):
+        """
+        Decode and letterbox reference images into the pinned staging buffer,
+        matching WanVace.prepare_source.
+        
+        Args:
+            paths: List of reference image paths
+            size: Video size as (width, height)
+        
+        Returns:
+            List of (3, 1, H, W) views of the staging buffer
+        """
+        width, height = size
+        # Wait until the previous request's copy out of the buffer is done
+        if self._ref_staging_event is not None:
+            self._ref_staging_event.synchronize()
+        
+        staging = self._ref_staging[:len(paths) * 3 * height * width].view(
+            len(paths), 3, 1, height, width)
+        for ref, path in zip(staging, paths):
+            ref_img = TF.to_tensor(Image.open(path).convert("RGB")).sub_(0.5).div_(0.5)
+            if ref_img.shape[-2:] == (height, width):
+                ref[:, 0].copy_(ref_img)
+                continue
+            ref_height, ref_width = ref_img.shape[-2:]
+            scale = min(height / ref_height, width / ref_width)
+            new_height = int(ref_height * scale)
+            new_width = int(ref_width * scale)
+            top = (height - new_height) // 2
+            left = (width - new_width) // 2
+            ref.fill_(1.0)
+            ref[:, 0, top:top + new_height, left:left + new_width] = F.interpolate(
+                ref_img.unsqueeze(0),
+                size=(new_height, new_width),
+                mode='bilinear',
+                align_corners=False).squeeze(0)
+        return list(staging)
+    
+    def _ref_key(self, path, size):
+        """Reference cache key, changing when the image file is modified"""
+        return (os.path.abspath(path), os.stat(path).st_mtime_ns, size)
+    
+    def _prompt_key(self, prompt):
+        key = f"{self.cfg.t5_checkpoint}\0{prompt}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def encode_prompts(self, prompts, offload_model=True):
+        """
+        Get T5 embeddings for prompts, encoding only those not yet cached.
+        Embeddings of a CPU-resident T5 are kept in pinned memory so the
+        pipeline can copy them to the GPU asynchronously.
+        
+        Args:
+            prompts: List of text prompts
+            offload_model: Whether to offload T5 after encoding
+        
+        Returns:
+            List of T5 embeddings, one per prompt
+        """
+        keys = [self._prompt_key(prompt) for prompt in prompts]
+        missing = [
+            prompt for prompt, key in zip(prompts, keys)
+            if key not in self._prompt_cache
+        ]
+        
+        if missing:
+            logging.info(f"Encoding {len(missing)} uncached prompt(s)")
+            encoded = self.pipeline.encode_prompt(missing, offload_model)
+            for prompt, context in zip(missing, encoded):
+                if self.t5_cpu:
+                    context = [t.pin_memory() for t in context]
+                self._prompt_cache[self._prompt_key(prompt)] = context
+        
+        embeds = []
+        for key in keys:
+            self._prompt_cache.move_to_end(key)
+            embeds.append(self._prompt_cache[key])
+        while len(self._prompt_cache) > _MAX_CACHED_PROMPTS:
+            self._prompt_cache.popitem(last=False)
+        return embeds
     
     def generate(
         self,
@@ -81,7 +655,9 @@ class WanFastGenerator:
         sample_solver='unipc',
         guide_scale=5.0,
         base_seed=-1,
-        offload_model=True
+        offload_model=None,
+        enable_teacache=False,
+        teacache_thresh=0.08
     ):
         """
         Generate video quickly (models already loaded)
@@ -97,110 +673,542 @@ class WanFastGenerator:
             sample_solver: Solver type
             guide_scale: Guidance scale
             base_seed: Random seed
-            offload_model: Whether to offload model after generation
+            offload_model: Whether to offload models to CPU after generation.
+                None offloads only until the generator is reused from the
+                cache, after which the weights stay on the GPU
+            enable_teacache: Whether to skip DiT forwards with TeaCache
+            teacache_thresh: TeaCache threshold, higher skips more steps
+        
+        Returns:
+            Path to generated video, written in the background (see wait_all())
+        """
+        return self.generate_batch(
+            [prompt],
+            src_ref_images=[src_ref_images],
+            save_files=[save_file],
+            size=size,
+            frame_num=frame_num,
+            sample_steps=sample_steps,
+            sample_shift=sample_shift,
+            sample_solver=sample_solver,
+            guide_scale=guide_scale,
+            base_seeds=[base_seed],
+            offload_model=offload_model,
+            enable_teacache=enable_teacache,
+            teacache_thresh=teacache_thresh
+        )[0]
+    
+    def generate_batch(
+        self,
+        prompts,
+        src_ref_images=None,
+        save_files=None,
+        size="832*480",
+        frame_num=41,
+        sample_steps=25,
+        sample_shift=16.0,
+        sample_solver='unipc',
+        guide_scale=5.0,
+        base_seeds=None,
+        offload_model=None,
+        enable_teacache=False,
+        teacache_thresh=0.08
+    ):
+        """
+        Generate several videos with one batched DiT forward per step.
+        If the batch runs out of GPU memory it is split in halves and retried.
+        
+        Args:
+            prompts: List of text prompts
+            src_ref_images: Comma-separated reference image paths per prompt
+            save_files: Output path per prompt (None entries get a default)
+            base_seeds: Random seed per prompt
+            Remaining arguments are shared by all prompts, see generate()
         
         Returns:
-            Path to generated video
+            List of paths to generated videos, written in the background
+            (see wait_all())
         """
-        logging.info(f"Generating video with prompt: {prompt}")
+        if offload_model is None:
+            offload_model = self._offload_default
+        count = len(prompts)
+        src_ref_images = src_ref_images or [None] * count
+        # Resolved before any split so the halves keep each prompt's index
+        save_files = [
+            save_file or self._default_save_file(
+                prompt, size, index=i if count > 1 else None)
+            for i, (prompt, save_file) in enumerate(
+                zip(prompts, save_files or [None] * count))
+        ]
+        base_seeds = [
+            seed if seed >= 0 else random.randint(0, sys.maxsize)
+            for seed in (base_seeds or [-1] * count)
+        ]
+        if self.ulysses_size > 1:
+            # Every rank must sample the same noise
+            dist.broadcast_object_list(base_seeds, src=0)
+        kwargs = dict(
+            size=size,
+            frame_num=frame_num,
+            sample_steps=sample_steps,
+            sample_shift=sample_shift,
+            sample_solver=sample_solver,
+            guide_scale=guide_scale,
+            offload_model=offload_model,
+            enable_teacache=enable_teacache,
+            teacache_thresh=teacache_thresh
+        )
+        
+        free_memory, _ = torch.cuda.mem_get_info(self.pipeline.device)
+        logging.info(
+            f"Generating {count} video(s), {free_memory / 2**30:.1f} GiB GPU memory free")
+        try:
+            videos = self._sample_batch(
+                prompts, src_ref_images, base_seeds, **kwargs)
+        except torch.cuda.OutOfMemoryError:
+            if count == 1:
+                raise
+            logging.warning(f"Out of memory with batch size {count}, splitting")
+            gc.collect()
+            torch.cuda.empty_cache()
+            half = count // 2
+            return (
+                self.generate_batch(
+                    prompts[:half], src_ref_images[:half], save_files[:half],
+                    base_seeds=base_seeds[:half], **kwargs) +
+                self.generate_batch(
+                    prompts[half:], src_ref_images[half:], save_files[half:],
+                    base_seeds=base_seeds[half:], **kwargs))
         
-        if base_seed < 0:
-            base_seed = random.randint(0, sys.maxsize)
+        if self.cudnn_benchmark and (size, frame_num) not in self._warmup_shapes:
+            self._warmup_shapes.append((size, frame_num))
+            del self._warmup_shapes[:-_MAX_WARMUP_SHAPES]
+            if self.rank == 0:
+                _save_warmup_shapes(self._warmup_key, self._warmup_shapes)
+        
+        # Other ranks only help sample, the pipeline decodes on rank 0
+        if self.rank != 0:
+            return save_files
+        return [
+            self._save_video(video, save_file)
+            for video, save_file in zip(videos, save_files)
+        ]
+    
+    def _sample_batch(self, prompts, src_ref_images, base_seeds, size, frame_num,
+                      sample_steps, sample_shift, sample_solver, guide_scale,
+                      offload_model, enable_teacache, teacache_thresh):
+        """
+        Run the pipeline on a batch and return the video tensors. Only
+        per-request tensors come from the request memory pool, weights and
+        cached tensors are allocated outside it so the pool never pins them.
+        """
+        for prompt in prompts:
+            logging.info(f"Generating video with prompt: {prompt}")
         
         # Prepare reference images if provided
-        src_video = None
-        src_mask = None
-        ref_images_list = None
+        ref_paths_list = []
+        for paths in src_ref_images:
+            paths = paths.split(',') if paths else None
+            if paths:
+                logging.info(f"Reference images: {paths}")
+            ref_paths_list.append(paths)
         
-        if src_ref_images:
-            ref_images_list = [src_ref_images.split(',')]
-            logging.info(f"Reference images: {ref_images_list}")
+        # Reuse references already on the GPU, and decode the rest through
+        # the staging buffer when they fit. Otherwise, e.g. for a size outside
+        # SUPPORTED_SIZES[task], prepare_source loads them from their paths
+        width, height = SIZE_CONFIGS[size]
+        ref_keys = {
+            path: self._ref_key(path, size)
+            for paths in ref_paths_list if paths for path in paths
+        }
+        missing = [
+            path for path, key in ref_keys.items() if key not in self._ref_cache
+        ]
+        staged = bool(missing) and (
+            len(missing) * 3 * height * width <= self._ref_staging.numel())
+        refs = dict(zip(
+            missing, self._load_refs_to_staging(missing, SIZE_CONFIGS[size])
+        )) if staged else {}
+        for path, key in ref_keys.items():
+            if key in self._ref_cache:
+                self._ref_cache.move_to_end(key)
+                refs[path] = self._ref_cache[key]
+        ref_images_list = [
+            [refs.get(path, path) for path in paths] if paths else None
+            for paths in ref_paths_list
+        ]
         
         # Prepare source data
-        src_video, src_mask, src_ref_images_tensor = self.pipeline.prepare_source(
-            [src_video],
-            [src_mask],
-            ref_images_list,
-            frame_num,
-            SIZE_CONFIGS[size],
-            self.device_id
-        )
+        with self._request_memory():
+            src_video, src_mask, src_ref_images_tensor = self.pipeline.prepare_source(
+                [None] * len(prompts),
+                [None] * len(prompts),
+                ref_images_list,
+                frame_num,
+                SIZE_CONFIGS[size],
+                self.device_id
+            )
+        if staged:
+            self._ref_staging_event = torch.cuda.Event()
+            self._ref_staging_event.record(
+                torch.cuda.current_stream(self.pipeline.device))
+        for paths, ref_images in zip(ref_paths_list, src_ref_images_tensor):
+            for path, ref_image in zip(paths or [], ref_images or []):
+                if ref_keys[path] not in self._ref_cache:
+                    # Copy out of the request pool
+                    self._ref_cache[ref_keys[path]] = ref_image.clone()
+        while len(self._ref_cache) > _MAX_CACHED_REFS:
+            self._ref_cache.popitem(last=False)
         
-        # Generate video
-        logging.info("Generating video...")
-        video = self.pipeline.generate(
-            prompt,
-            src_video,
-            src_mask,
-            src_ref_images_tensor,
-            size=SIZE_CONFIGS[size],
-            frame_num=frame_num,
-            shift=sample_shift,
-            sample_solver=sample_solver,
-            sampling_steps=sample_steps,
-            guide_scale=guide_scale,
-            seed=base_seed,
-            offload_model=offload_model
-        )
+        *prompt_embeds, n_prompt_embeds = self.encode_prompts(
+            [*prompts, self.cfg.sample_neg_prompt], offload_model)
+        
+        while len(self._seed_generators) < len(prompts):
+            self._seed_generators.append(
+                torch.Generator(device=self.pipeline.device))
         
-        # Save video
-        if save_file is None:
-            formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            formatted_prompt = prompt.replace(" ", "_").replace("/", "_")[:50]
-            save_file = f"{self.task}_{size}_{formatted_prompt}_{formatted_time}.mp4"
+        # Bring back offloaded DiT weights, the pipeline's own move would
+        # allocate them from the request pool, as would the forward's lazy
+        # move of the RoPE table
+        self.pipeline.model.to(self.pipeline.device)
+        dit = getattr(self.dit, "module", self.dit)
+        dit.freqs = dit.freqs.to(self.pipeline.device)
         
+        # Generate video
+        logging.info("Generating video...")
+        with self._request_memory(), torch.inference_mode():
+            return self.pipeline.generate_batch(
+                prompts,
+                src_video,
+                src_mask,
+                src_ref_images_tensor,
+                size=SIZE_CONFIGS[size],
+                frame_num=frame_num,
+                shift=sample_shift,
+                sample_solver=sample_solver,
+                sampling_steps=sample_steps,
+                guide_scale=guide_scale,
+                seeds=base_seeds,
+                # bitsandbytes weights cannot round-trip through the CPU
+                offload_model=offload_model and self.quantize == "none",
+                prompt_embeds=prompt_embeds,
+                n_prompt_embeds=n_prompt_embeds,
+                enable_teacache=enable_teacache,
+                teacache_thresh=teacache_thresh,
+                generators=self._seed_generators
+            )
+    
+    def _default_save_file(self, prompt, size, index=None):
+        formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        formatted_prompt = prompt.replace(" ", "_").replace("/", "_")[:50]
+        suffix = "" if index is None else f"_{index}"
+        return f"{self.task}_{size}_{formatted_prompt}_{formatted_time}{suffix}.mp4"
+    
+    def _save_video(self, video, save_file):
+        """Queue a generated video tensor for encoding and return its path"""
         logging.info(f"Saving generated video to {save_file}")
-        cache_video(
-            tensor=video[None],
-            save_file=save_file,
-            fps=self.cfg.sample_fps,
-            nrow=1,
-            normalize=True,
-            value_range=(-1, 1)
-        )
+        # Convert on the GPU so only uint8 frames cross to the encode thread
+        frames = video_to_uint8(
+            video[None], nrow=1, normalize=True, value_range=(-1, 1)).contiguous()
+        frames_host = self._pinned_frames(frames.shape)
+        
+        # Copy on a side stream so the next request's work is not queued
+        # behind it, the encode thread waits on the event instead
+        self._copy_stream.wait_stream(
+            torch.cuda.current_stream(self.pipeline.device))
+        with torch.cuda.stream(self._copy_stream):
+            frames_host.copy_(frames, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+        frames.record_stream(self._copy_stream)
         
-        logging.info("✓ Video generation complete!")
+        self._pending_saves[save_file] = self._encode_pool.submit(
+            self._write_video, frames_host, copied, save_file)
         return save_file
+    
+    def _pinned_frames(self, shape):
+        """Take a free pinned frame buffer of this shape, or allocate one"""
+        with self._frames_host_lock:
+            for i, frames_host in enumerate(self._frames_host):
+                if frames_host.shape == shape:
+                    return self._frames_host.pop(i)
+        return torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+    
+    def _write_video(self, frames_host, copied, save_file):
+        """Encode uint8 frames to mp4, run on the encode pool"""
+        try:
+            copied.synchronize()
+            if write_video(frames_host, save_file, fps=self.cfg.sample_fps) is None:
+                raise RuntimeError(f"Failed to write video to {save_file}")
+        finally:
+            with self._frames_host_lock:
+                self._frames_host.append(frames_host)
+                # One buffer per encode worker covers back-to-back requests
+                del self._frames_host[:-_ENCODE_WORKERS]
+        logging.info(f"✓ Video generation complete: {save_file}")
+    
+    def wait_all(self, save_files=None):
+        """
+        Block until queued videos are written to disk.
+        
+        Args:
+            save_files: Paths to wait for, all pending videos if None
+        
+        Raises:
+            RuntimeError: If a video could not be written
+        """
+        if save_files is None:
+            save_files = list(self._pending_saves)
+        for save_file in save_files:
+            future = self._pending_saves.pop(save_file, None)
+            if future is not None:
+                future.result()
 
 
-def get_generator(task="vace-1.3B", ckpt_dir=None, device_id=0):
+def get_generator(task="vace-1.3B", ckpt_dir=None, device_id=0, t5_cpu=True,
+                  dtype="bf16", cuda_graph=False, compile=False,
+                  attention_backend="auto", cudnn_benchmark=True,
+                  mem_pool=True, quantize="none", ulysses_size=1):
     """
     Get or create a cached generator instance.
-    Models are loaded once and reused.
+    Models are loaded once and reused. When the cache is full the least
+    recently used generator is evicted to free its GPU memory. A generator
+    fetched again keeps its weights on the GPU unless offload_model is given.
     
     Args:
         task: Task type
         ckpt_dir: Checkpoint directory
         device_id: GPU device ID
+        t5_cpu: Whether to keep the T5 encoder on CPU
+        dtype: DiT weight dtype, one of DTYPES
+        cuda_graph: Whether to replay the DiT forward from CUDA graphs
+        compile: Whether to torch.compile the DiT
+        attention_backend: Attention kernel, one of ATTENTION_BACKENDS
+        cudnn_benchmark: Whether to autotune cuDNN convs
+        mem_pool: Whether to use a dedicated memory pool for requests
+        quantize: DiT weight quantization, one of QUANTIZE_MODES
+        ulysses_size: Number of GPUs to split the DiT across
         
     Returns:
         WanFastGenerator instance
     """
-    cache_key = f"{task}_{ckpt_dir}_{device_id}"
+    cache_key = (task, ckpt_dir, device_id, t5_cpu, dtype, cuda_graph,
+                 compile, attention_backend, cudnn_benchmark, mem_pool,
+                 quantize, ulysses_size)
     
     if cache_key not in _MODEL_CACHE:
+        while len(_MODEL_CACHE) >= _MAX_CACHED_GENERATORS:
+            evicted_key = next(iter(_MODEL_CACHE))
+            del _MODEL_CACHE[evicted_key]
+            logging.info(f"Evicting cached generator: {evicted_key}")
+            gc.collect()
+            torch.cuda.empty_cache()
         logging.info(f"Creating new generator (first run - will be slow)")
         _MODEL_CACHE[cache_key] = WanFastGenerator(
             task=task,
             ckpt_dir=ckpt_dir,
-            device_id=device_id
+            device_id=device_id,
+            t5_cpu=t5_cpu,
+            dtype=dtype,
+            cuda_graph=cuda_graph,
+            compile=compile,
+            attention_backend=attention_backend,
+            cudnn_benchmark=cudnn_benchmark,
+            mem_pool=mem_pool,
+            quantize=quantize,
+            ulysses_size=ulysses_size
         )
     else:
         logging.info(f"Using cached generator (fast!)")
+        _MODEL_CACHE.move_to_end(cache_key)
+        # A resident generator keeps its weights on the GPU between calls
+        _MODEL_CACHE[cache_key]._offload_default = False
     
     return _MODEL_CACHE[cache_key]
 
 
-def main():
-    """Command-line interface"""
+class _GenerateRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one JSON generate request per connection. Requests pick the model
+    with REQUEST_MODEL_KWARGS, the server's own flags pick how it runs.
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            model_kwargs = {
+                key: request["model"][key] for key in REQUEST_MODEL_KWARGS}
+            generate_kwargs = request["generate"]
+            generator_kwargs = dict(self.server.generator_kwargs, **model_kwargs)
+            with self.server.gpu_lock:
+                if dist.is_initialized():
+                    # The other ranks mirror every call, see _follow_requests()
+                    dist.broadcast_object_list(
+                        [model_kwargs, generate_kwargs], src=0)
+                generator = get_generator(**generator_kwargs)
+                # Handler threads start on the default CUDA device
+                with torch.cuda.device(generator.pipeline.device):
+                    output_file = generator.generate(**generate_kwargs)
+            # The next request starts sampling while this video is encoded
+            generator.wait_all([output_file])
+            response = {"output": os.path.abspath(output_file)}
+        except Exception as e:
+            logging.exception("Generate request failed")
+            response = {"error": f"{type(e).__name__}: {e}"}
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+def _follow_requests(generator_kwargs):
+    """
+    Run the generate requests rank 0 receives on one of the other ranks,
+    with this rank's own flags so its ulysses_size and GPU never change.
+    """
+    while True:
+        request = [None, None]
+        dist.broadcast_object_list(request, src=0)
+        model_kwargs, generate_kwargs = request
+        try:
+            get_generator(**generator_kwargs, **model_kwargs).generate(
+                **generate_kwargs)
+        except Exception:
+            logging.exception("Generate request failed")
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, **generator_kwargs):
+    """
+    Load the pipeline once and serve generate requests over a Unix socket.
+    Requests sample one at a time so they never compete for the GPU, but
+    each waits for its mp4 encode only after releasing it. With the DiT
+    split across GPUs only rank 0 listens and forwards requests to the rest.
+    
+    Args:
+        socket_path: Path of the Unix domain socket to listen on
+        **generator_kwargs: Default keyword arguments for get_generator()
+    """
+    _init_logging()
+    get_generator(**generator_kwargs).pretune()
+    if dist.is_initialized() and dist.get_rank() != 0:
+        _follow_requests(generator_kwargs)
+        return
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with socketserver.ThreadingUnixStreamServer(
+            socket_path, _GenerateRequestHandler) as server:
+        server.generator_kwargs = generator_kwargs
+        server.gpu_lock = threading.Lock()
+        logging.info(f"✓ Serving generate requests on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+
+def request_generate(generator_kwargs, generate_kwargs,
+                     socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Send a generate request to a running server. Only the task and
+    checkpoint are sent along, the server keeps its own performance flags.
+    
+    Args:
+        generator_kwargs: Keyword arguments for get_generator()
+        generate_kwargs: Keyword arguments for WanFastGenerator.generate()
+        socket_path: Path of the server's Unix domain socket
+        
+    Returns:
+        Absolute path to generated video, or None if no server is listening
+    """
+    if not os.path.exists(socket_path):
+        return None
+    
+    # The server resolves paths against its own working directory
+    model_kwargs = {key: generator_kwargs[key] for key in REQUEST_MODEL_KWARGS}
+    model_kwargs["ckpt_dir"] = os.path.abspath(model_kwargs["ckpt_dir"])
+    generate_kwargs = dict(generate_kwargs)
+    if generate_kwargs.get("save_file"):
+        generate_kwargs["save_file"] = os.path.abspath(generate_kwargs["save_file"])
+    if generate_kwargs.get("src_ref_images"):
+        generate_kwargs["src_ref_images"] = ",".join(
+            os.path.abspath(path)
+            for path in generate_kwargs["src_ref_images"].split(","))
+    
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(socket_path)
+    except OSError:
+        return None
+
+    with conn, conn.makefile("rwb") as stream:
+        request = {"model": model_kwargs, "generate": generate_kwargs}
+        stream.write((json.dumps(request) + "\n").encode("utf-8"))
+        stream.flush()
+        response = json.loads(stream.readline())
+    if "error" in response:
+        raise RuntimeError(f"Server failed to generate video: {response['error']}")
+    return response["output"]
+
+
+def _parse_args(argv=None):
+    """Parse and validate command-line arguments"""
+    args, unknown_args = _parse_known_args(argv)
+    if unknown_args:
+        _build_parser().error(
+            f"unrecognized arguments: {' '.join(unknown_args)}")
+    return args
+
+
+def _parse_known_args(argv=None):
+    """
+    Parse and validate command-line arguments, returning unrecognized ones
+    instead of exiting on them
+    """
+    parser = _build_parser()
+    args, unknown_args = parser.parse_known_args(argv)
+    
+    if not args.serve and args.prompt is None:
+        parser.error("--prompt is required unless --serve is given")
+    
+    return args, unknown_args
+
+
+def _build_parser():
+    """Command-line parser shared by the CLI and in-process callers"""
     parser = argparse.ArgumentParser(
         description="Fast Wan video generation with model preloading"
     )
     parser.add_argument("--task", type=str, default="vace-1.3B")
     parser.add_argument("--ckpt_dir", type=str, required=True)
     parser.add_argument("--device_id", type=int, default=0)
+    parser.add_argument(
+        "--t5_cpu", type=str2bool, nargs="?", const=True, default=True,
+        help="Keep the T5 encoder on CPU to free GPU memory for the DiT")
+    parser.add_argument(
+        "--dtype", type=str, default="bf16", choices=list(DTYPES),
+        help="Weight dtype of the DiT attention and FFN layers")
+    parser.add_argument(
+        "--cuda_graph", action="store_true", default=False,
+        help="Capture the DiT forward into CUDA graphs and replay it each step")
+    parser.add_argument(
+        "--compile", action="store_true", default=False,
+        help="torch.compile the DiT (reduce-overhead) and warm it up at load")
+    parser.add_argument(
+        "--attention_backend", type=str, default="auto",
+        choices=ATTENTION_BACKENDS,
+        help="Attention kernel: flash attention 3/2 or fused PyTorch SDPA")
+    parser.add_argument(
+        "--cudnn_benchmark", type=str2bool, default=True,
+        help="Autotune cuDNN convs, and with --serve pre-tune recently seen shapes")
+    parser.add_argument(
+        "--mem_pool", type=str2bool, default=True,
+        help="Allocate per-request tensors from a dedicated CUDA memory pool")
+    parser.add_argument(
+        "--quantize", type=str, default="none", choices=QUANTIZE_MODES,
+        help="Quantize the DiT attention and FFN weights with bitsandbytes")
+    parser.add_argument(
+        "--ulysses_size", type=int, default=1,
+        help="Split the DiT across this many GPUs, one process each")
     parser.add_argument("--src_ref_images", type=str, default=None)
-    parser.add_argument("--prompt", type=str, required=True)
+    parser.add_argument("--prompt", type=str, default=None)
     parser.add_argument("--save_file", type=str, default=None)
     parser.add_argument("--size", type=str, default="832*480")
     parser.add_argument("--frame_num", type=int, default=41)
@@ -209,19 +1217,46 @@ def main():
     parser.add_argument("--sample_solver", type=str, default='unipc')
     parser.add_argument("--sample_guide_scale", type=float, default=5.0)
     parser.add_argument("--base_seed", type=int, default=-1)
-    parser.add_argument("--offload_model", type=str2bool, default=True)
-    
-    args = parser.parse_args()
-    
-    # Get or create generator (models loaded once)
-    generator = get_generator(
+    parser.add_argument(
+        "--offload_model", type=str2bool, default=None,
+        help="Offload models to CPU after generating, by default only when "
+        "the pipeline is not reused")
+    parser.add_argument(
+        "--enable_teacache", action="store_true", default=False,
+        help="Reuse the previous noise prediction on near-identical steps")
+    parser.add_argument("--teacache_thresh", type=float, default=0.08)
+    parser.add_argument(
+        "--serve", action="store_true", default=False,
+        help="Keep the pipeline loaded and serve requests on --socket")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET_PATH)
+    parser.add_argument(
+        "--no_server", action="store_true", default=False,
+        help="Always load the pipeline in this process")
+    return parser
+
+
+def generator_kwargs_from_args(args):
+    """Keyword arguments for get_generator() from parsed arguments"""
+    return dict(
         task=args.task,
-        ckpt_dir=args.ckpt_dir,
-        device_id=args.device_id
+        # Spellings of the same directory share one cached generator
+        ckpt_dir=os.path.abspath(args.ckpt_dir),
+        device_id=args.device_id,
+        t5_cpu=args.t5_cpu,
+        dtype=args.dtype,
+        cuda_graph=args.cuda_graph,
+        compile=args.compile,
+        attention_backend=args.attention_backend,
+        cudnn_benchmark=args.cudnn_benchmark,
+        mem_pool=args.mem_pool,
+        quantize=args.quantize,
+        ulysses_size=args.ulysses_size
     )
-    
-    # Generate video (fast!)
-    output_file = generator.generate(
+
+
+def generate_kwargs_from_args(args):
+    """Keyword arguments for WanFastGenerator.generate() from parsed arguments"""
+    return dict(
         prompt=args.prompt,
         src_ref_images=args.src_ref_images,
         save_file=args.save_file,
@@ -232,12 +1267,60 @@ def main():
         sample_solver=args.sample_solver,
         guide_scale=args.sample_guide_scale,
         base_seed=args.base_seed,
-        offload_model=args.offload_model
+        offload_model=args.offload_model,
+        enable_teacache=args.enable_teacache,
+        teacache_thresh=args.teacache_thresh
     )
+
+
+def _run(args):
+    """Serve or generate in this process, one of several with --ulysses_size"""
+    generator_kwargs = generator_kwargs_from_args(args)
+    
+    if args.serve:
+        serve(socket_path=args.socket, **generator_kwargs)
+        return
     
-    print(f"Output: {output_file}")
+    # Get or create generator (models loaded once)
+    generator = get_generator(**generator_kwargs)
+    
+    # Generate video (fast!)
+    output_file = generator.generate(**generate_kwargs_from_args(args))
+    generator.wait_all()
+    if generator.rank == 0:
+        print(f"Output: {output_file}")
+
+
+def _run_rank(local_rank, args):
+    """Entry point of a process started by main() for one GPU"""
+    os.environ["RANK"] = os.environ["LOCAL_RANK"] = str(local_rank)
+    _run(args)
+
+
+def main():
+    """Command-line interface"""
+    args = _parse_args()
+    launched = "WORLD_SIZE" in os.environ
+    
+    # Reuse a resident server if one is listening
+    if not (args.serve or args.no_server or launched):
+        output_file = request_generate(
+            generator_kwargs_from_args(args), generate_kwargs_from_args(args),
+            socket_path=args.socket)
+        if output_file is not None:
+            print(f"Output: {output_file}")
+            return
+    
+    if args.ulysses_size > 1 and not launched:
+        # Start one process per GPU, as torchrun would
+        os.environ["WORLD_SIZE"] = str(args.ulysses_size)
+        os.environ.setdefault("MASTER_ADDR", "localhost")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        torch.multiprocessing.spawn(
+            _run_rank, args=(args,), nprocs=args.ulysses_size)
+    else:
+        _run(args)
 
 
 if __name__ == "__main__":
     main()
-
@@ -6,9 +6,13 @@ Uses Anthropic's Claude to create an optimized video generation prompt.
 
 import argparse
 import base64
+import mmap
 import os
+import re
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
 # Load environment variables from .env file
@@ -22,44 +26,65 @@ except ImportError:
 import anthropic
 
 
-def encode_image_to_base64(image_path: str) -> str:
-    """Read image and encode to base64."""
+def encode_image_to_base64(image_path: str) -> bytes:
+    """Encode an image to base64 bytes straight from a memory map of the file."""
     with open(image_path, "rb") as image_file:
-        return base64.standard_b64encode(image_file.read()).decode("utf-8")
+        if os.fstat(image_file.fileno()).st_size == 0:
+            return b""
+        with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return base64.b64encode(mm)
+
+
+REASONING_END_MARKER = b"--- END OF REASONING ---"
+PROMPT_MARKER = "Generating image with prompt:"
+
+# First line that mentions the prompt marker or starts with "Cartoon"
+_PROMPT_START = re.compile(
+    r"^(?=.*" + re.escape(PROMPT_MARKER) + r"|[^\S\n]*Cartoon)", re.MULTILINE)
+
+
+def _decode_text(data: bytes) -> str:
+    """Decode UTF-8 with universal newlines, as text-mode open() would."""
+    return data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
 
 
 def read_reasoning_file(text_path: str) -> dict:
     """Read the reasoning trace file and extract reasoning and original prompt."""
-    with open(text_path, "r", encoding="utf-8") as f:
-        content = f.read()
-    
-    # Split by the reasoning end marker
-    parts = content.split("--- END OF REASONING ---")
-    
-    if len(parts) >= 2:
-        reasoning = parts[0].strip()
-        # Extract the final prompt (after the reasoning)
-        remaining = parts[1].strip()
-        lines = remaining.split("\n")
-        # Find the actual prompt (usually after "Generating image with prompt:")
-        original_prompt = ""
-        for i, line in enumerate(lines):
-            if "Generating image with prompt:" in line or line.strip().startswith("Cartoon"):
-                # Get the prompt from the next non-empty lines
-                prompt_lines = []
-                for j in range(i, len(lines)):
-                    if lines[j].strip():
-                        prompt_lines.append(lines[j].strip())
-                original_prompt = " ".join(prompt_lines).replace("Generating image with prompt:", "").strip()
-                break
-        
-        if not original_prompt:
-            # Fallback: use everything after reasoning
-            original_prompt = remaining
-    else:
+    with open(text_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {"reasoning": "", "original_prompt": ""}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Search the mapped bytes so only the two sections get decoded
+            end = mm.find(REASONING_END_MARKER)
+            if end < 0:
+                content = _decode_text(mm[:])
+            else:
+                start = end + len(REASONING_END_MARKER)
+                stop = mm.find(REASONING_END_MARKER, start)
+                reasoning = _decode_text(mm[:end]).strip()
+                remaining = _decode_text(
+                    mm[start:stop if stop >= 0 else len(mm)]).strip()
+    
+    if end < 0:
         # No marker found, try to split differently
-        reasoning = content[:len(content)//2]
-        original_prompt = content[len(content)//2:]
+        return {
+            "reasoning": content[:len(content)//2],
+            "original_prompt": content[len(content)//2:]
+        }
+    
+    # Find the actual prompt (usually after "Generating image with prompt:")
+    match = _PROMPT_START.search(remaining)
+    if match:
+        prompt_lines = remaining[match.start():].split("\n")
+        original_prompt = " ".join(
+            line.strip() for line in prompt_lines if line.strip()
+        ).replace(PROMPT_MARKER, "").strip()
+    else:
+        original_prompt = ""
+    
+    if not original_prompt:
+        # Fallback: use everything after reasoning
+        original_prompt = remaining
     
     return {
         "reasoning": reasoning,
@@ -71,9 +96,13 @@ def generate_video_prompt_with_claude(
     image_path: str,
     reasoning: str,
     original_prompt: str,
-    api_key: str
+    api_key: str,
+    image_data: bytes = None
 ) -> str:
-    """Use Claude to generate an optimized video generation prompt."""
+    """Use Claude to generate an optimized video generation prompt.
+    
+    image_data may hold the already base64-encoded image to skip re-reading it.
+    """
     
     # Determine image media type
     ext = Path(image_path).suffix.lower()
@@ -87,7 +116,8 @@ def generate_video_prompt_with_claude(
     media_type = media_type_map.get(ext, "image/png")
     
     # Encode image
-    image_data = encode_image_to_base64(image_path)
+    if image_data is None:
+        image_data = encode_image_to_base64(image_path)
     
     # Create the prompt for Claude
     system_prompt = """You are an expert in video generation and creative direction. Your task is to take a static image and its creation reasoning, and generate an engaging video generation prompt that brings the image to life with motion, dynamics, and cinematic appeal.
@@ -136,7 +166,7 @@ Provide ONLY the video generation prompt, nothing else. No explanations, no prea
                         "source": {
                             "type": "base64",
                             "media_type": media_type,
-                            "data": image_data,
+                            "data": image_data.decode("ascii"),
                         },
                     },
                     {
@@ -158,6 +188,72 @@ def generate_video(
     size: str = "1280*720",
     ckpt_dir: str = "./Wan2.1-T2V-14B",
     output_dir: str = None,
+    additional_args: list = None,
+    use_subprocess: bool = False
+):
+    """Create the video, in-process when the task supports it.
+    
+    VACE tasks run through the cached generator in generate_integrated_fast,
+    so weights and CUDA state persist across calls. Other tasks, or
+    use_subprocess=True, fall back to running generate.py.
+    """
+    if not use_subprocess and "vace" in task:
+        _generate_video_in_process(
+            prompt, task, size, ckpt_dir, output_dir, additional_args)
+    else:
+        _generate_video_subprocess(
+            prompt, task, size, ckpt_dir, output_dir, additional_args)
+
+
+def _generate_video_in_process(
+    prompt: str,
+    task: str,
+    size: str,
+    ckpt_dir: str,
+    output_dir: str = None,
+    additional_args: list = None
+):
+    """Generate the video with a cached in-process generator."""
+    import generate_integrated_fast as fast
+    
+    argv = [
+        "--task", task,
+        "--size", size,
+        "--ckpt_dir", ckpt_dir,
+        "--prompt", prompt
+    ]
+    if additional_args:
+        argv.extend(additional_args)
+    # Extra arguments are meant for generate.py, drop those the fast path
+    # does not know
+    args, ignored_args = fast._parse_known_args(argv)
+    if ignored_args:
+        print(f"⚠️  Ignoring arguments not supported in-process: {' '.join(ignored_args)}")
+    
+    generate_kwargs = fast.generate_kwargs_from_args(args)
+    if output_dir and generate_kwargs["save_file"] is None:
+        os.makedirs(output_dir, exist_ok=True)
+        formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        generate_kwargs["save_file"] = os.path.join(
+            output_dir, f"{task}_{size}_{formatted_time}.mp4")
+    
+    print("\n" + "="*80)
+    print("GENERATING VIDEO IN-PROCESS:")
+    print(" ".join(argv))
+    print("="*80 + "\n")
+    
+    generator = fast.get_generator(**fast.generator_kwargs_from_args(args))
+    output_file = generator.generate(**generate_kwargs)
+    generator.wait_all()
+    print(f"\n✓ Video generation completed successfully: {output_file}")
+
+
+def _generate_video_subprocess(
+    prompt: str,
+    task: str,
+    size: str,
+    ckpt_dir: str,
+    output_dir: str = None,
     additional_args: list = None
 ):
     """Call generate.py to create the video."""
@@ -242,6 +338,11 @@ def main():
         action="store_true",
         help="Skip Claude API call and use original prompt directly"
     )
+    parser.add_argument(
+        "--subprocess",
+        action="store_true",
+        help="Run generate.py in a child process instead of in-process"
+    )
     
     args, unknown_args = parser.parse_known_args()
     
@@ -278,6 +379,13 @@ def main():
     print("READING REASONING AND ORIGINAL PROMPT...")
     print("-"*80)
     
+    # Encode the image in the background while the reasoning file is parsed
+    executor = ThreadPoolExecutor(max_workers=1)
+    image_future = None
+    if not args.skip_claude:
+        image_future = executor.submit(encode_image_to_base64, args.image)
+    executor.shutdown(wait=False)
+    
     data = read_reasoning_file(args.text)
     reasoning = data["reasoning"]
     original_prompt = data["original_prompt"]
@@ -300,7 +408,8 @@ def main():
                 args.image,
                 reasoning,
                 original_prompt,
-                api_key
+                api_key,
+                image_data=image_future.result()
             )
             print(f"\n✓ Claude generated video prompt:\n")
             print("="*80)
@@ -316,14 +425,15 @@ def main():
     print("GENERATING VIDEO...")
     print("-"*80)
     
-    # generate_video(
-    #     prompt=video_prompt,
-    #     task=args.task,
-    #     size=args.size,
-    #     ckpt_dir=args.ckpt_dir,
-    #     output_dir=args.output_dir,
-    #     additional_args=unknown_args
-    # )
+    generate_video(
+        prompt=video_prompt,
+        task=args.task,
+        size=args.size,
+        ckpt_dir=args.ckpt_dir,
+        output_dir=args.output_dir,
+        additional_args=unknown_args,
+        use_subprocess=args.subprocess
+    )
     
     print("\n" + "="*80)
     print("✓ COMPLETE!")
@@ -1,5 +1,11 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import concurrent.futures
+import functools
+import itertools
+import os
+
 import torch
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
 try:
     import flash_attn_interface
@@ -18,8 +24,97 @@ import warnings
 __all__ = [
     'flash_attention',
     'attention',
+    'set_attention_backend',
 ]
 
+ATTENTION_BACKENDS = ('auto', 'flash3', 'flash2', 'sdpa')
+
+# Fused SDPA kernels; the unfused math kernel materializes the full QK^T
+SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+
+_attention_backend = 'auto'
+
+
+def set_attention_backend(backend):
+    """
+    Select the attention kernel used by `flash_attention` and `attention`.
+
+    backend:        'auto' prefers flash attention 3, then 2, then SDPA.
+                    'flash3', 'flash2' and 'sdpa' force one implementation.
+    """
+    global _attention_backend
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f'Unknown attention backend: {backend}')
+    if backend == 'flash3' and not FLASH_ATTN_3_AVAILABLE:
+        raise ValueError('Flash attention 3 is not available.')
+    if backend == 'flash2' and not FLASH_ATTN_2_AVAILABLE:
+        raise ValueError('Flash attention 2 is not available.')
+    _attention_backend = backend
+
+
+set_attention_backend(os.environ.get('WAN_ATTENTION_BACKEND', 'auto'))
+
+
+# torch.cuda.use_mem_pool only routes the calling thread's allocations, so
+# cached tensors are copied to the device here to stay out of a caller's
+# short-lived memory pool
+_cache_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='wan-attention-cache')
+
+
+def _to_device_persistent(tensor, device):
+
+    def copy():
+        with torch.cuda.device(device):
+            tensor_device = tensor.to(device)
+            torch.cuda.current_stream().synchronize()
+        return tensor_device
+
+    return _cache_executor.submit(copy).result()
+
+
+# Unbounded: captured CUDA graphs read these tensors by address, so one must
+# never be freed while a graph may replay. There is one entry per distinct
+# batch of lengths, each a few bytes.
+@functools.lru_cache(maxsize=None)
+def _cached_cu_seqlens(lens, device):
+    return _to_device_persistent(
+        torch.tensor((0, *itertools.accumulate(lens)), dtype=torch.int32),
+        device)
+
+
+def cu_seqlens(lens, device):
+    """
+    Cumulative sequence lengths for varlen attention. Host-side lengths are
+    cached per device so repeated shapes skip the host-to-device copy, which
+    also keeps the forward free of copies under CUDA graph capture.
+    """
+    if lens.device.type == 'cpu':
+        return _cached_cu_seqlens(tuple(lens.tolist()), device)
+    return torch.cat([lens.new_zeros([1]), lens]).cumsum(0, dtype=torch.int32)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_key_padding_mask(lens, lk, device):
+    mask = torch.arange(lk).view(1, 1, 1, lk) < torch.tensor(lens).view(
+        -1, 1, 1, 1)
+    return _to_device_persistent(mask, device)
+
+
+def key_padding_mask(lens, lk, device):
+    """
+    [B, 1, 1, Lk] mask of the keys within each sample's length, or None when
+    no sample is padded. Host-side lengths are checked on the host and their
+    masks cached per device, like `cu_seqlens`.
+    """
+    if lens.device.type == 'cpu':
+        lens = tuple(lens.tolist())
+        if min(lens) >= lk:
+            return None
+        return _cached_key_padding_mask(lens, lk, device)
+    return (torch.arange(lk, device=device).view(1, 1, 1, lk) <
+            lens.view(-1, 1, 1, 1))
+
 
 def flash_attention(
     q,
@@ -62,9 +157,7 @@ def flash_attention(
     # preprocess query
     if q_lens is None:
         q = half(q.flatten(0, 1))
-        q_lens = torch.tensor(
-            [lq] * b, dtype=torch.int32).to(
-                device=q.device, non_blocking=True)
+        q_lens = torch.tensor([lq] * b, dtype=torch.int32)
     else:
         q = half(torch.cat([u[:v] for u, v in zip(q, q_lens)]))
 
@@ -72,9 +165,7 @@ def flash_attention(
     if k_lens is None:
         k = half(k.flatten(0, 1))
         v = half(v.flatten(0, 1))
-        k_lens = torch.tensor(
-            [lk] * b, dtype=torch.int32).to(
-                device=k.device, non_blocking=True)
+        k_lens = torch.tensor([lk] * b, dtype=torch.int32)
     else:
         k = half(torch.cat([u[:v] for u, v in zip(k, k_lens)]))
         v = half(torch.cat([u[:v] for u, v in zip(v, k_lens)]))
@@ -90,17 +181,20 @@ def flash_attention(
             'Flash attention 3 is not available, use flash attention 2 instead.'
         )
 
+    use_flash3 = FLASH_ATTN_3_AVAILABLE and _attention_backend in ('auto',
+                                                                   'flash3')
+    use_flash2 = FLASH_ATTN_2_AVAILABLE and _attention_backend in ('auto',
+                                                                   'flash2')
+
     # apply attention
-    if (version is None or version == 3) and FLASH_ATTN_3_AVAILABLE:
+    if (version is None or version == 3) and use_flash3:
         # Note: dropout_p, window_size are not supported in FA3 now.
         x = flash_attn_interface.flash_attn_varlen_func(
             q=q,
             k=k,
             v=v,
-            cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
+            cu_seqlens_q=cu_seqlens(q_lens, q.device),
+            cu_seqlens_k=cu_seqlens(k_lens, q.device),
             seqused_q=None,
             seqused_k=None,
             max_seqlen_q=lq,
@@ -108,15 +202,13 @@ def flash_attention(
             softmax_scale=softmax_scale,
             causal=causal,
             deterministic=deterministic)[0].unflatten(0, (b, lq))
-    elif FLASH_ATTN_2_AVAILABLE:
+    elif use_flash2:
         x = flash_attn.flash_attn_varlen_func(
             q=q,
             k=k,
             v=v,
-            cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
+            cu_seqlens_q=cu_seqlens(q_lens, q.device),
+            cu_seqlens_k=cu_seqlens(k_lens, q.device),
             max_seqlen_q=lq,
             max_seqlen_k=lk,
             dropout_p=dropout_p,
@@ -126,10 +218,11 @@ def flash_attention(
             deterministic=deterministic).unflatten(0, (b, lq))
     else:
         # Fallback to PyTorch's scaled_dot_product_attention when flash attention is not available
-        warnings.warn(
-            'Flash attention is not available. Using PyTorch scaled_dot_product_attention as fallback. '
-            'For optimal performance, consider fixing flash-attn installation.'
-        )
+        if _attention_backend != 'sdpa':
+            warnings.warn(
+                'Flash attention is not available. Using PyTorch scaled_dot_product_attention as fallback. '
+                'For optimal performance, consider fixing flash-attn installation.'
+            )
         # Need to reconstruct the original batch structure for PyTorch attention
         # Unflatten q, k, v back to batch dimension
         q_batched = q.new_zeros(b, lq, q.size(-2), q.size(-1))
@@ -152,20 +245,23 @@ def flash_attention(
         k_batched = k_batched.transpose(1, 2)
         v_batched = v_batched.transpose(1, 2)
         
-        # Apply PyTorch's scaled_dot_product_attention
-        attn_mask = None
+        # Apply PyTorch's scaled_dot_product_attention. Batched samples can
+        # have different key lengths, and their zero-padded keys must not
+        # take part in the softmax
+        attn_mask = key_padding_mask(k_lens, lk, q.device)
         if causal:
             # Create causal mask for each batch element based on actual sequence lengths
             # For simplicity, we'll use is_causal=True which works for full sequences
             pass
         
-        x_batched = torch.nn.functional.scaled_dot_product_attention(
-            q_batched, k_batched, v_batched, 
-            attn_mask=attn_mask, 
-            dropout_p=dropout_p if dropout_p > 0 else 0.0,
-            is_causal=causal,
-            scale=softmax_scale
-        )
+        with sdpa_kernel(SDPA_BACKENDS):
+            x_batched = torch.nn.functional.scaled_dot_product_attention(
+                q_batched, k_batched, v_batched, 
+                attn_mask=attn_mask, 
+                dropout_p=dropout_p if dropout_p > 0 else 0.0,
+                is_causal=causal,
+                scale=softmax_scale
+            )
         
         # Transpose back and flatten to match flash attention output format
         x_batched = x_batched.transpose(1, 2)
@@ -199,7 +295,8 @@ def attention(
     dtype=torch.bfloat16,
     fa_version=None,
 ):
-    if FLASH_ATTN_2_AVAILABLE or FLASH_ATTN_3_AVAILABLE:
+    if _attention_backend != 'sdpa' and (FLASH_ATTN_2_AVAILABLE or
+                                         FLASH_ATTN_3_AVAILABLE):
         return flash_attention(
             q=q,
             k=k,
@@ -226,8 +323,14 @@ def attention(
         k = k.transpose(1, 2).to(dtype)
         v = v.transpose(1, 2).to(dtype)
 
-        out = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, attn_mask=attn_mask, is_causal=causal, dropout_p=dropout_p)
+        with sdpa_kernel(SDPA_BACKENDS):
+            out = torch.nn.functional.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=attn_mask,
+                is_causal=causal,
+                dropout_p=dropout_p)
 
         out = out.transpose(1, 2).contiguous()
         return out
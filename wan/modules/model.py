@@ -22,8 +22,9 @@ def sinusoidal_embedding_1d(dim, position):
     position = position.type(torch.float64)
 
     # calculation
-    sinusoid = torch.outer(
-        position, torch.pow(10000, -torch.arange(half).to(position).div(half)))
+    exponent = torch.arange(
+        half, dtype=position.dtype, device=position.device).div(half)
+    sinusoid = torch.outer(position, torch.pow(10000, -exponent))
     x = torch.cat([torch.cos(sinusoid), torch.sin(sinusoid)], dim=1)
     return x
 
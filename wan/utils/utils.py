@@ -20,6 +20,28 @@ def rand_name(length=8, suffix=''):
     return name
 
 
+def video_to_uint8(tensor, nrow=8, normalize=True, value_range=(-1, 1)):
+    r"""
+    Converts a [B, C, T, H, W] video batch into [T, H, W, C] uint8 frames,
+    tiling the batch into a grid of `nrow` columns per frame.
+    """
+    tensor = tensor.clamp(min(value_range), max(value_range))
+    if tensor.size(0) == 1 and tensor.size(1) == 3 and normalize:
+        # a single RGB video needs no grid, so normalize the whole clip in
+        # place instead of once per frame
+        low, high = value_range
+        tensor = tensor[0].sub_(low).div_(max(high - low, 1e-5)).mul_(255)
+        return tensor.permute(1, 2, 3, 0).type(torch.uint8)
+
+    tensor = torch.stack([
+        torchvision.utils.make_grid(
+            u, nrow=nrow, normalize=normalize, value_range=value_range)
+        for u in tensor.unbind(2)
+    ],
+                         dim=1).permute(1, 2, 3, 0)
+    return (tensor * 255).type(torch.uint8)
+
+
 def cache_video(tensor,
                 save_file=None,
                 fps=30,
@@ -32,27 +54,27 @@ def cache_video(tensor,
     cache_file = osp.join('/tmp', rand_name(
         suffix=suffix)) if save_file is None else save_file
 
+    # preprocess
+    frames = video_to_uint8(tensor, nrow, normalize, value_range).cpu()
+
     # save to cache
+    return write_video(frames, cache_file, fps=fps, retry=retry)
+
+
+def write_video(frames, save_file, fps=30, retry=5):
+    r"""
+    Encodes [T, H, W, C] uint8 frames on the CPU into `save_file`.
+    Returns the file path, or None if every attempt failed.
+    """
     error = None
     for _ in range(retry):
         try:
-            # preprocess
-            tensor = tensor.clamp(min(value_range), max(value_range))
-            tensor = torch.stack([
-                torchvision.utils.make_grid(
-                    u, nrow=nrow, normalize=normalize, value_range=value_range)
-                for u in tensor.unbind(2)
-            ],
-                                 dim=1).permute(1, 2, 3, 0)
-            tensor = (tensor * 255).type(torch.uint8).cpu()
-
-            # write video
             writer = imageio.get_writer(
-                cache_file, fps=fps, codec='libx264', quality=8)
-            for frame in tensor.numpy():
+                save_file, fps=fps, codec='libx264', quality=8)
+            for frame in frames.numpy():
                 writer.append_data(frame)
             writer.close()
-            return cache_file
+            return save_file
         except Exception as e:
             error = e
             continue
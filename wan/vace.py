@@ -8,7 +8,7 @@ import sys
 import time
 import traceback
 import types
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from functools import partial
 
 import torch
@@ -18,8 +18,10 @@ import torch.multiprocessing as mp
 import torch.nn.functional as F
 import torchvision.transforms.functional as TF
 from PIL import Image
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from tqdm import tqdm
 
+from .modules.model import sinusoidal_embedding_1d
 from .modules.vace_model import VaceWanModel
 from .text2video import (
     FlowDPMSolverMultistepScheduler,
@@ -250,7 +252,11 @@ class WanVace(WanT2V):
             if ref_images is not None:
                 image_size = image_sizes[i]
                 for j, ref_img in enumerate(ref_images):
-                    if ref_img is not None:
+                    if isinstance(ref_img, torch.Tensor):
+                        # already decoded and letterboxed by the caller
+                        src_ref_images[i][j] = ref_img.to(
+                            device, non_blocking=True)
+                    elif ref_img is not None:
                         ref_img = Image.open(ref_img).convert("RGB")
                         ref_img = TF.to_tensor(ref_img).sub_(0.5).div_(
                             0.5).unsqueeze(1)
@@ -277,6 +283,80 @@ class WanVace(WanT2V):
                         src_ref_images[i][j] = ref_img.to(device)
         return src_video, src_mask, src_ref_images
 
+    def encode_prompt(self, prompts, offload_model=True):
+        r"""
+        Encodes text prompts with the T5 encoder.
+
+        Args:
+            prompts (`list[str]`):
+                Text prompts to encode, one forward pass each
+            offload_model (`bool`, *optional*, defaults to True):
+                If True, moves T5 back to CPU after encoding
+
+        Returns:
+            list[list[torch.Tensor]]:
+                T5 context for each prompt. Tensors stay on CPU when `t5_cpu`
+                is set and are on the target device otherwise.
+        """
+        if self.t5_cpu:
+            return [
+                self.text_encoder([prompt], torch.device('cpu'))
+                for prompt in prompts
+            ]
+
+        self.text_encoder.model.to(self.device)
+        contexts = [
+            self.text_encoder([prompt], self.device) for prompt in prompts
+        ]
+        if offload_model:
+            self.text_encoder.model.cpu()
+        return contexts
+
+    def teacache_skip_steps(self, timesteps, thresh):
+        r"""
+        Selects sampling steps whose DiT forward can be skipped, TeaCache style.
+
+        The relative L1 change of the DiT timestep embedding between steps is
+        accumulated, and a step is skipped while the total stays below
+        `thresh`. The first and last steps are always computed. The
+        embedding depends only on the timestep, so the schedule does not
+        depend on the prompt.
+
+        Args:
+            timesteps (`torch.Tensor`):
+                Sampling timesteps
+            thresh (`float`):
+                Accumulated relative L1 distance below which a step is skipped
+
+        Returns:
+            list[bool]:
+                Whether to reuse the previous noise prediction at each step
+        """
+        # Outside the forward an FSDP root keeps its own parameters, the time
+        # embedding's among them, sharded; gather only those, not the blocks
+        if isinstance(self.model, FSDP):
+            full_params = FSDP.summon_full_params(
+                self.model, recurse=False, writeback=False)
+        else:
+            full_params = nullcontext()
+        with full_params, amp.autocast(enabled=False):
+            e = self.model.time_embedding(
+                sinusoidal_embedding_1d(self.model.freq_dim,
+                                        timesteps).float())
+        rel_l1 = ((e[1:] - e[:-1]).abs().mean(dim=1) /
+                  e[:-1].abs().mean(dim=1)).tolist()
+
+        skip = [False]
+        accumulated = 0.0
+        for i, distance in enumerate(rel_l1, start=1):
+            accumulated += distance
+            if i < len(rel_l1) and accumulated < thresh:
+                skip.append(True)
+            else:
+                skip.append(False)
+                accumulated = 0.0
+        return skip
+
     def decode_latent(self, zs, ref_images=None, vae=None):
         vae = self.vae if vae is None else vae
         if ref_images is None:
@@ -306,7 +386,11 @@ class WanVace(WanT2V):
                  guide_scale=5.0,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 prompt_embeds=None,
+                 n_prompt_embeds=None,
+                 enable_teacache=False,
+                 teacache_thresh=0.08):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -331,6 +415,16 @@ class WanVace(WanT2V):
                 Random seed for noise generation. If -1, use random seed.
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            prompt_embeds (`list[torch.Tensor]`, *optional*, defaults to None):
+                Precomputed T5 context for `input_prompt`, as returned by
+                `encode_prompt`. If None, the prompt is encoded here.
+            n_prompt_embeds (`list[torch.Tensor]`, *optional*, defaults to None):
+                Precomputed T5 context for the negative prompt.
+            enable_teacache (`bool`, *optional*, defaults to False):
+                If True, reuses the previous noise prediction on steps chosen
+                by `teacache_skip_steps`
+            teacache_thresh (`float`, *optional*, defaults to 0.08):
+                TeaCache threshold. Higher values skip more steps
 
         Returns:
             torch.Tensor:
@@ -340,33 +434,114 @@ class WanVace(WanT2V):
                 - H: Frame height (from size)
                 - W: Frame width from size)
         """
-        # preprocess
-        # F = frame_num
-        # target_shape = (self.vae.model.z_dim, (F - 1) // self.vae_stride[0] + 1,
-        #                 size[1] // self.vae_stride[1],
-        #                 size[0] // self.vae_stride[2])
-        #
-        # seq_len = math.ceil((target_shape[2] * target_shape[3]) /
-        #                     (self.patch_size[1] * self.patch_size[2]) *
-        #                     target_shape[1] / self.sp_size) * self.sp_size
+        prompt_embeds = None if prompt_embeds is None else [prompt_embeds]
+        videos = self.generate_batch([input_prompt],
+                                   input_frames,
+                                   input_masks,
+                                   input_ref_images,
+                                   size=size,
+                                   frame_num=frame_num,
+                                   context_scale=context_scale,
+                                   shift=shift,
+                                   sample_solver=sample_solver,
+                                   sampling_steps=sampling_steps,
+                                   guide_scale=guide_scale,
+                                   n_prompt=n_prompt,
+                                   seeds=[seed],
+                                   offload_model=offload_model,
+                                   prompt_embeds=prompt_embeds,
+                                   n_prompt_embeds=n_prompt_embeds,
+                                   enable_teacache=enable_teacache,
+                                   teacache_thresh=teacache_thresh)
+        return videos[0] if videos is not None else None
+
+    def generate_batch(self,
+                       input_prompts,
+                       input_frames,
+                       input_masks,
+                       input_ref_images,
+                       size=(1280, 720),
+                       frame_num=81,
+                       context_scale=1.0,
+                       shift=5.0,
+                       sample_solver='unipc',
+                       sampling_steps=50,
+                       guide_scale=5.0,
+                       n_prompt="",
+                       seeds=None,
+                       offload_model=True,
+                       prompt_embeds=None,
+                       n_prompt_embeds=None,
+                       enable_teacache=False,
+                       teacache_thresh=0.08,
+                       generators=None):
+        r"""
+        Generates several videos at once, running the DiT on all samples in a
+        single batched forward per step. Each sample keeps its own seed and
+        scheduler state. Arguments match `generate`, except:
+
+        Args:
+            input_prompts (`list[str]`):
+                Text prompt for each sample
+            input_frames, input_masks, input_ref_images (`list`):
+                Per-sample VACE inputs, as returned by `prepare_source`
+            seeds (`list[int]`, *optional*, defaults to None):
+                Random seed for each sample. -1 or None picks a random seed.
+            prompt_embeds (`list[list[torch.Tensor]]`, *optional*, defaults to None):
+                Precomputed T5 context for each prompt
+            generators (`list[torch.Generator]`, *optional*, defaults to None):
+                Long-lived device generators to reseed, at least one per
+                sample. New ones are created when None.
 
+        Returns:
+            list[torch.Tensor]:
+                Generated video frames for each sample, (C, N, H, W)
+        """
+        batch_size = len(input_prompts)
         if n_prompt == "":
             n_prompt = self.sample_neg_prompt
-        seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
-        seed_g = torch.Generator(device=self.device)
-        seed_g.manual_seed(seed)
-
-        if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        if seeds is None:
+            seeds = [-1] * batch_size
+        if generators is None:
+            generators = [
+                torch.Generator(device=self.device) for _ in range(batch_size)
+            ]
+        seed_gs = []
+        for seed, seed_g in zip(seeds, generators):
+            seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
+            seed_g.manual_seed(seed)
+            seed_gs.append(seed_g)
+
+        if prompt_embeds is None:
+            prompt_embeds = [None] * batch_size
+        missing = [
+            prompt for prompt, embeds in zip(input_prompts, prompt_embeds)
+            if embeds is None
+        ]
+        if n_prompt_embeds is None:
+            missing.append(n_prompt)
+        encoded = iter(
+            self.encode_prompt(missing, offload_model) if missing else [])
+        prompt_embeds = [
+            next(encoded) if embeds is None else embeds
+            for embeds in prompt_embeds
+        ]
+        if n_prompt_embeds is None:
+            n_prompt_embeds = next(encoded)
+
+        # T5 outputs of a CPU-resident encoder are uploaded on a side stream,
+        # overlapping the VAE encode below
+        compute_stream = torch.cuda.current_stream(self.device)
+        upload_stream = torch.cuda.Stream(self.device)
+        with torch.cuda.stream(upload_stream):
+            context = [
+                t.to(self.device, non_blocking=True)
+                for embeds in prompt_embeds
+                for t in embeds
+            ]
+            context_null = [
+                t.to(self.device, non_blocking=True) for t in n_prompt_embeds
+            ] * batch_size
 
         # vace context encode
         z0 = self.vace_encode_frames(
@@ -374,21 +549,24 @@ class WanVace(WanT2V):
         m0 = self.vace_encode_masks(input_masks, input_ref_images)
         z = self.vace_latent(z0, m0)
 
-        target_shape = list(z0[0].shape)
-        target_shape[0] = int(target_shape[0] / 2)
-        noise = [
-            torch.randn(
-                target_shape[0],
-                target_shape[1],
-                target_shape[2],
-                target_shape[3],
-                dtype=torch.float32,
-                device=self.device,
-                generator=seed_g)
-        ]
-        seq_len = math.ceil((target_shape[2] * target_shape[3]) /
-                            (self.patch_size[1] * self.patch_size[2]) *
-                            target_shape[1] / self.sp_size) * self.sp_size
+        compute_stream.wait_stream(upload_stream)
+        for t in context + context_null:
+            t.record_stream(compute_stream)
+
+        noise = []
+        for z0_i, seed_g in zip(z0, seed_gs):
+            target_shape = list(z0_i.shape)
+            target_shape[0] = int(target_shape[0] / 2)
+            noise.append(
+                torch.randn(
+                    *target_shape,
+                    dtype=torch.float32,
+                    device=self.device,
+                    generator=seed_g))
+        seq_len = max(
+            math.ceil((u.shape[2] * u.shape[3]) /
+                      (self.patch_size[1] * self.patch_size[2]) * u.shape[1] /
+                      self.sp_size) * self.sp_size for u in noise)
 
         @contextmanager
         def noop_no_sync():
@@ -399,26 +577,29 @@ class WanVace(WanT2V):
         # evaluation mode
         with amp.autocast(dtype=self.param_dtype), torch.no_grad(), no_sync():
 
-            if sample_solver == 'unipc':
-                sample_scheduler = FlowUniPCMultistepScheduler(
-                    num_train_timesteps=self.num_train_timesteps,
-                    shift=1,
-                    use_dynamic_shifting=False)
-                sample_scheduler.set_timesteps(
-                    sampling_steps, device=self.device, shift=shift)
-                timesteps = sample_scheduler.timesteps
-            elif sample_solver == 'dpm++':
-                sample_scheduler = FlowDPMSolverMultistepScheduler(
-                    num_train_timesteps=self.num_train_timesteps,
-                    shift=1,
-                    use_dynamic_shifting=False)
-                sampling_sigmas = get_sampling_sigmas(sampling_steps, shift)
-                timesteps, _ = retrieve_timesteps(
-                    sample_scheduler,
-                    device=self.device,
-                    sigmas=sampling_sigmas)
-            else:
-                raise NotImplementedError("Unsupported solver.")
+            sample_schedulers = []
+            for _ in range(batch_size):
+                if sample_solver == 'unipc':
+                    sample_scheduler = FlowUniPCMultistepScheduler(
+                        num_train_timesteps=self.num_train_timesteps,
+                        shift=1,
+                        use_dynamic_shifting=False)
+                    sample_scheduler.set_timesteps(
+                        sampling_steps, device=self.device, shift=shift)
+                    timesteps = sample_scheduler.timesteps
+                elif sample_solver == 'dpm++':
+                    sample_scheduler = FlowDPMSolverMultistepScheduler(
+                        num_train_timesteps=self.num_train_timesteps,
+                        shift=1,
+                        use_dynamic_shifting=False)
+                    sampling_sigmas = get_sampling_sigmas(sampling_steps, shift)
+                    timesteps, _ = retrieve_timesteps(
+                        sample_scheduler,
+                        device=self.device,
+                        sigmas=sampling_sigmas)
+                else:
+                    raise NotImplementedError("Unsupported solver.")
+                sample_schedulers.append(sample_scheduler)
 
             # sample videos
             latents = noise
@@ -426,36 +607,52 @@ class WanVace(WanT2V):
             arg_c = {'context': context, 'seq_len': seq_len}
             arg_null = {'context': context_null, 'seq_len': seq_len}
 
-            for _, t in enumerate(tqdm(timesteps)):
+            self.model.to(self.device)
+            if enable_teacache:
+                skip_steps = self.teacache_skip_steps(timesteps,
+                                                      teacache_thresh)
+                logging.info(
+                    f'TeaCache skips {sum(skip_steps)}/{len(skip_steps)} steps')
+            else:
+                skip_steps = [False] * len(timesteps)
+
+            for t, skip in zip(tqdm(timesteps), skip_steps):
                 latent_model_input = latents
-                timestep = [t]
+                timestep = [t] * batch_size
 
                 timestep = torch.stack(timestep)
 
                 self.model.to(self.device)
-                noise_pred_cond = self.model(
-                    latent_model_input,
-                    t=timestep,
-                    vace_context=z,
-                    vace_context_scale=context_scale,
-                    **arg_c)[0]
-                noise_pred_uncond = self.model(
-                    latent_model_input,
-                    t=timestep,
-                    vace_context=z,
-                    vace_context_scale=context_scale,
-                    **arg_null)[0]
-
-                noise_pred = noise_pred_uncond + guide_scale * (
-                    noise_pred_cond - noise_pred_uncond)
-
-                temp_x0 = sample_scheduler.step(
-                    noise_pred.unsqueeze(0),
-                    t,
-                    latents[0].unsqueeze(0),
-                    return_dict=False,
-                    generator=seed_g)[0]
-                latents = [temp_x0.squeeze(0)]
+                if not skip:
+                    noise_pred_cond = self.model(
+                        latent_model_input,
+                        t=timestep,
+                        vace_context=z,
+                        vace_context_scale=context_scale,
+                        **arg_c)
+                    noise_pred_uncond = self.model(
+                        latent_model_input,
+                        t=timestep,
+                        vace_context=z,
+                        vace_context_scale=context_scale,
+                        **arg_null)
+
+                    noise_pred = [
+                        uncond + guide_scale * (cond - uncond)
+                        for cond, uncond in zip(noise_pred_cond,
+                                                noise_pred_uncond)
+                    ]
+
+                latents = [
+                    sample_scheduler.step(
+                        u.unsqueeze(0),
+                        t,
+                        latent.unsqueeze(0),
+                        return_dict=False,
+                        generator=seed_g)[0].squeeze(0)
+                    for sample_scheduler, u, latent, seed_g in zip(
+                        sample_schedulers, noise_pred, latents, seed_gs)
+                ]
 
             x0 = latents
             if offload_model:
@@ -465,14 +662,14 @@ class WanVace(WanT2V):
                 videos = self.decode_latent(x0, input_ref_images)
 
         del noise, latents
-        del sample_scheduler
+        del sample_schedulers
         if offload_model:
             gc.collect()
             torch.cuda.synchronize()
         if dist.is_initialized():
             dist.barrier()
 
-        return videos[0] if self.rank == 0 else None
+        return videos if self.rank == 0 else None
 
 
 class WanVaceMP(WanVace):